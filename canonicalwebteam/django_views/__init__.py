@@ -1,44 +1,148 @@
 # System
 import os
+import posixpath
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # Packages
+import cmarkgfm
 import frontmatter
-import glob
-import re
-from django.http import Http404, HttpResponseRedirect
-from django.template import Context, loader, TemplateDoesNotExist
+from cmarkgfm.cmark import Options
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponseRedirect
+from django.template import loader
+from django.utils._os import safe_join
 from django.views.generic.base import TemplateView
-from mistune import Markdown, BlockLexer
 
 
-def _insensitive_glob(pattern, base_dir):
+@lru_cache(maxsize=None)
+def _template_trie(template_dir):
     """
-    Look for files with glob patterns,
-    but case ignoring case
+    Build a trie of all the files and directories in a template directory,
+    for looking up paths while ignoring case.
+
+    Each node maps casefolded names to a list of (name, child) tuples,
+    one for each entry with that name in any case. "child" is the node
+    for a directory, or None for a file.
+
+    Each real directory is scanned once, and its node is shared by every
+    path leading to it, so symlinks to the same directory, or to a parent
+    directory, reuse one node instead of looping.
     """
 
-    def either(c):
-        return "[%s%s]" % (c.lower(), c.upper()) if c.isalpha() else c
+    trie = {}
+    nodes = {os.path.realpath(template_dir): trie}
+    pending = [(template_dir, trie)]
+
+    while pending:
+        directory, node = pending.pop()
+
+        try:
+            with os.scandir(directory) as directory_entries:
+                entries = list(directory_entries)
+        except OSError:
+            # Missing or unreadable directories hold no templates
+            continue
+
+        for entry in entries:
+            child = None
+
+            if entry.is_dir():
+                real_directory = os.path.realpath(entry.path)
+                child = nodes.get(real_directory)
 
-    search = "".join(map(either, pattern))
-    search_path = os.path.join(base_dir, search)
+                if child is None:
+                    child = nodes[real_directory] = {}
+                    pending.append((entry.path, child))
 
-    return glob.glob(search_path)
+            node.setdefault(entry.name.casefold(), []).append(
+                (entry.name, child)
+            )
 
+    return trie
 
-def _template_exists(path):
+
+@lru_cache(maxsize=1024)
+def _list_files(directory):
     """
-    Check if a template exists
-    without raising an exception
+    List the names of the files in a directory
     """
 
     try:
-        loader.get_template(path)
-        return True
-    except (TemplateDoesNotExist, OSError):
-        return False
+        with os.scandir(directory) as entries:
+            return frozenset(
+                entry.name for entry in entries if entry.is_file()
+            )
+    except OSError:
+        # Missing or unreadable directories, or files
+        return frozenset()
+
+
+def _case_insensitive_resolve(relative_path, trie):
+    """
+    Find the directories in a template trie matching relative_path,
+    ignoring case, one path segment at a time.
+
+    Returns a list of (path, node) tuples, for each matching path,
+    with a trailing "/", and its node in the trie.
+    """
 
+    directories = [("", trie)]
 
+    for segment in relative_path.split("/"):
+        if not segment:
+            continue
+
+        segment = segment.casefold()
+        directories = [
+            (directory + name + "/", child)
+            for directory, node in directories
+            for name, child in node.get(segment, ())
+            if child is not None
+        ]
+
+    return directories
+
+
+@lru_cache(maxsize=None)
+def _template_dirs():
+    """
+    The template directories of the first configured template engine
+    """
+
+    first_engine_name = next(iter(loader.engines.templates))
+
+    return tuple(loader.engines.templates[first_engine_name]["DIRS"])
+
+
+def _template_filepath(path):
+    """
+    Find the absolute filepath of a template file in the template
+    directories, without going through Django's template loaders.
+    Each directory is only listed once, however many files are checked.
+
+    Returns None if there's no such file.
+    """
+
+    for template_dir in _template_dirs():
+        try:
+            filepath = safe_join(template_dir, path)
+        except SuspiciousFileOperation:
+            # Don't look outside the template directory
+            continue
+
+        directory, filename = os.path.split(filepath)
+
+        if filename in _list_files(directory):
+            return filepath
+
+    return None
+
+
+@lru_cache(maxsize=4096)
 def _find_template_url(path):
     """
     Look for a template by:
@@ -49,18 +153,27 @@ def _find_template_url(path):
 
     matches = []
 
-    first_engine_name = next(iter(loader.engines.templates))
-    template_dirs = loader.engines.templates[first_engine_name]["DIRS"]
+    parent_path, _, name = path.rpartition("/")
+    name = name.casefold()
+    names = (name, name + ".html", name + ".md")
 
-    for template_dir in template_dirs:
-        for match in (
-            _insensitive_glob(path, template_dir)
-            + _insensitive_glob(path + ".html", template_dir)
-            + _insensitive_glob(path + ".md", template_dir)
-        ):
-            cleaned_match = re.sub(r"^" + template_dir, "", match)
-            cleaned_match = re.sub(r"\.(html|md)$", "", cleaned_match)
-            matches.append(cleaned_match)
+    for template_dir in _template_dirs():
+        trie = _template_trie(template_dir)
+
+        for directory, node in _case_insensitive_resolve(parent_path, trie):
+            if not name:
+                # The URL ends in "/", so the directory itself is the match
+                matches.append("/" + directory)
+                continue
+
+            for key in names:
+                for match, _ in node.get(key, ()):
+                    if match.endswith(".html"):
+                        match = match[:-5]
+                    elif match.endswith(".md"):
+                        match = match[:-3]
+
+                    matches.append("/" + directory + match)
 
     # Only return a found template if we found only one
     if (
@@ -86,76 +199,393 @@ def _relative_template_path(path, origin_filepath):
         # so template loader can do its work
         path = path.lstrip("/")
     else:
-        # "relative" path, use the existing filepath
-        path = os.path.relpath(
-            os.path.join(os.path.dirname(origin_filepath), path)
+        # "relative" path, use the existing filepath.
+        # Template names always use "/", so use posixpath
+        path = posixpath.normpath(
+            posixpath.join(posixpath.dirname(origin_filepath), path)
         )
 
     return path
 
 
+# Suffixes to try on a URL path to find its template, in order.
+# Suffixes from _MARKDOWN_SUFFIX_INDEX onwards are Markdown files.
+_TEMPLATE_SUFFIXES = (".html", "/index.html", ".md", "/index.md")
+_MARKDOWN_SUFFIX_INDEX = 2
+
+
+@lru_cache(maxsize=4096)
 def _get_template(url_path):
     """
     Given a basic path, find an HTML or Markdown file
+
+    Returns a tuple of the template path
+    and whether it's a Markdown file
     """
 
     # Try to match HTML or Markdown files
-    if _template_exists(url_path + ".html"):
-        return url_path + ".html"
-    elif _template_exists(os.path.join(url_path, "index.html")):
-        return os.path.join(url_path, "index.html")
-    elif _template_exists(url_path + ".md"):
-        return url_path + ".md"
-    elif _template_exists(os.path.join(url_path, "index.md")):
-        return os.path.join(url_path, "index.md")
+    for index, suffix in enumerate(_TEMPLATE_SUFFIXES):
+        # Avoid "//" for paths ending in "/", or a leading "/" for ""
+        template_path = (url_path + suffix).replace("//", "/").lstrip("/")
+
+        if _template_filepath(template_path):
+            return template_path, index >= _MARKDOWN_SUFFIX_INDEX
 
     return None
 
 
-class WebteamBlockLexer(BlockLexer):
-    list_rules = (
-        "newline",
-        "block_code",
-        "fences",
-        "lheading",
-        "hrule",
-        "table",
-        "nptable",
-        "block_quote",
-        "list_block",
-        "block_html",
-        "text",
+def _has_template_syntax(contents):
+    """
+    Check if file contents contain any template tags,
+    variables or comments
+    """
+
+    return "{{" in contents or "{%" in contents or "{#" in contents
+
+
+@lru_cache(maxsize=4096)
+def _static_template_filepath(path):
+    """
+    Find the absolute filepath of an HTML template
+    which doesn't contain any template syntax,
+    so it can be served as it is
+    """
+
+    filepath = _template_filepath(path)
+
+    if not filepath:
+        return None
+
+    with open(filepath, encoding="utf-8") as template_file:
+        if _has_template_syntax(template_file.read()):
+            return None
+
+    return filepath
+
+
+def _clear_template_caches():
+    """
+    Forget which templates exist, so added or removed templates
+    are picked up, and forget parsed Markdown, so changes to templates
+    it includes or extends are picked up
+    """
+
+    _template_trie.cache_clear()
+    _list_files.cache_clear()
+    _find_template_url.cache_clear()
+    _get_template.cache_clear()
+    _static_template_filepath.cache_clear()
+    _load_template.cache_clear()
+    _parse_markdown_cached.cache_clear()
+    _INCLUDE_CACHE.clear()
+
+
+def parse_markdown(markdown):
+    """
+    Parse GitHub Flavored Markdown into HTML,
+    passing raw HTML through untouched.
+
+    The GFM "tagfilter" extension is left out, so tags like <iframe>
+    and <script> aren't escaped.
+    """
+
+    return cmarkgfm.markdown_to_html_with_extensions(
+        markdown,
+        options=Options.CMARK_OPT_UNSAFE | Options.CMARK_OPT_FOOTNOTES,
+        extensions=["table", "autolink", "strikethrough", "tasklist"],
     )
 
 
+@lru_cache(maxsize=1024)
+def _load_template(path):
+    """
+    Load a template through Django's template loaders,
+    remembering the result
+    """
+
+    return loader.get_template(path)
+
+
+def _template_mtime(path):
+    """
+    Find the modification time of the file behind a template,
+    for use as a cache key
+    """
+
+    template = _load_template(path)
+
+    return os.stat(template.origin.name).st_mtime_ns
+
+
+def _read_template_file(path):
+    """
+    Read the raw contents of the file behind a template
+    """
+
+    template = _load_template(path)
+
+    with open(template.origin.name, encoding="utf-8") as source:
+        return source.read()
+
+
+def _render_markdown_template(path):
+    """
+    Render a Markdown template containing template syntax.
+
+    Tags like {% now %} or {% trans %} can give different output for
+    each request, so this is done for every request, and never cached.
+    """
+
+    # Render through Django's template loaders, not _load_template.
+    # Outside DEBUG, Django's cached loader may still return the
+    # template as it was compiled before the file changed.
+    return loader.get_template(path).render()
+
+
+@lru_cache(maxsize=512)
+def _parse_markdown_cached(path, mtime, parser):
+    """
+    Read a Markdown template and parse it into HTML.
+
+    Returns a tuple of the frontmatter metadata and the parsed HTML,
+    or None if the file contains template syntax, so it must be
+    rendered for each request instead.
+    The result is shared between requests, so it mustn't be modified.
+    The "mtime" argument is only used to invalidate the cache.
+    "parser" turns Markdown into HTML, and is part of the cache key,
+    so views with different parsers don't share results.
+    """
+
+    file_contents = _read_template_file(path)
+
+    if _has_template_syntax(file_contents):
+        return None
+
+    markdown = frontmatter.loads(file_contents)
+
+    return markdown.metadata, parser(markdown.content)
+
+
+def _parse_markdown_page(path, parser):
+    """
+    Parse a Markdown page into a tuple of its frontmatter metadata
+    and HTML, from the cache, unless it contains template syntax
+    """
+
+    parsed_page = _parse_markdown_cached(path, _template_mtime(path), parser)
+
+    if parsed_page is None:
+        markdown = frontmatter.loads(_render_markdown_template(path))
+        parsed_page = markdown.metadata, parser(markdown.content)
+
+    return parsed_page
+
+
+# Parsed "markdown_includes", as {path: (mtime, parser, html)},
+# where "html" is None for includes containing template syntax
+_INCLUDE_CACHE = {}
+
+# For parsing several modified includes at once.
+# cmarkgfm releases the GIL while parsing, so they run in parallel.
+_INCLUDE_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+
+def _parse_markdown_include(path, mtime, parser):
+    """
+    Parse an included Markdown file into HTML, and cache it.
+
+    Returns None, and caches that, if the file contains template syntax,
+    so it's rendered for each request instead.
+    """
+
+    file_contents = _read_template_file(path)
+    html = None
+
+    if not _has_template_syntax(file_contents):
+        html = parser(file_contents)
+
+    _INCLUDE_CACHE[path] = (mtime, parser, html)
+
+    return html
+
+
+def _parse_markdown_includes(paths, parser):
+    """
+    Parse included Markdown files into HTML.
+
+    Includes are usually shared by many pages, so they're kept in their
+    own cache, where they can't be pushed out by pages, and each entry
+    is replaced when its file is modified. If several includes need
+    parsing, they're parsed in parallel.
+
+    Includes containing template syntax are rendered for every request,
+    in the request's own thread, so they use its active language.
+
+    Returns the HTML for each path, in order.
+    """
+
+    htmls = []
+    stale_includes = {}
+
+    for path in paths:
+        mtime = _template_mtime(path)
+        cached_include = _INCLUDE_CACHE.get(path)
+
+        if cached_include and cached_include[:2] == (mtime, parser):
+            htmls.append(cached_include[2])
+        else:
+            htmls.append(None)
+            stale_includes[len(htmls) - 1] = (path, mtime, parser)
+
+    if len(stale_includes) > 1:
+        parsed_htmls = _INCLUDE_EXECUTOR.map(
+            _parse_markdown_include, *zip(*stale_includes.values())
+        )
+    else:
+        parsed_htmls = (
+            _parse_markdown_include(*stale_include)
+            for stale_include in stale_includes.values()
+        )
+
+    for index, html in zip(stale_includes, parsed_htmls):
+        htmls[index] = html
+
+    for index, html in enumerate(htmls):
+        if html is None:
+            htmls[index] = parser(_render_markdown_template(paths[index]))
+
+    return htmls
+
+
+# The parts of a Markdown file needed to render it
+MarkdownResult = namedtuple("MarkdownResult", ["context", "template_filepath"])
+
+
+def _markdown_template_paths():
+    """
+    Find the paths of all Markdown files in the template directories,
+    following symlinks, but only scanning each real directory once
+    """
+
+    visited = set()
+
+    for template_dir in _template_dirs():
+        for directory, dirnames, filenames in os.walk(
+            template_dir, followlinks=True
+        ):
+            real_directory = os.path.realpath(directory)
+
+            # Don't loop forever on symlinks to parent directories
+            if real_directory in visited:
+                dirnames.clear()
+                continue
+
+            visited.add(real_directory)
+
+            for filename in filenames:
+                if filename.endswith(".md"):
+                    yield os.path.relpath(
+                        os.path.join(directory, filename), template_dir
+                    ).replace(os.sep, "/")
+
+
+def _warm_markdown_cache(view_class):
+    """
+    Parse the Markdown pages in the template directories,
+    so the first request for each page doesn't have to.
+
+    Files without a "wrapper_template", like includes, aren't pages,
+    and files with template syntax aren't cached, so they're skipped.
+    Warming stops once the page cache is full,
+    so it doesn't push out pages it has already parsed.
+    """
+
+    view = view_class()
+    cache_size = _parse_markdown_cached.cache_info().maxsize
+    warmed_pages = 0
+
+    for path in _markdown_template_paths():
+        if warmed_pages >= cache_size:
+            return
+
+        try:
+            file_contents = _read_template_file(path)
+
+            # Pages with template syntax are rendered for every request,
+            # so there's nothing to cache
+            if _has_template_syntax(file_contents):
+                continue
+
+            markdown = frontmatter.loads(file_contents)
+
+            if not markdown.metadata.get("wrapper_template"):
+                continue
+
+            view._parse_markdown_file(path)
+        except Exception:
+            # Leave broken files to fail when they're requested
+            continue
+
+        warmed_pages += 1
+
+
+_cache_warming_lock = threading.Lock()
+_cache_warming_thread = None
+
+
+def _start_cache_warming(view_class):
+    """
+    Warm the Markdown cache in a background thread,
+    once per process
+    """
+
+    global _cache_warming_thread
+
+    with _cache_warming_lock:
+        if _cache_warming_thread is None:
+            _cache_warming_thread = threading.Thread(
+                target=_warm_markdown_cache, args=(view_class,), daemon=True
+            )
+            _cache_warming_thread.start()
+
+
 class TemplateFinder(TemplateView):
-    parse_markdown = Markdown(
-        parse_block_html=True,
-        parse_inline_html=True,
-        block=WebteamBlockLexer(),
-    )
+    # Subclasses can override this with another static method,
+    # or callable class attribute, to change how Markdown is parsed
+    parse_markdown = staticmethod(parse_markdown)
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        """
+        Create the view, starting to warm the Markdown cache
+        if TEMPLATE_FINDER_WARM_CACHE is set
+        """
+
+        if getattr(settings, "TEMPLATE_FINDER_WARM_CACHE", False):
+            _start_cache_warming(cls)
+
+        return super().as_view(**initkwargs)
 
     def _parse_markdown_file(self, filepath):
         """
-        Parse a markdown file into the relevant parts.
+        Parse a markdown file into a MarkdownResult of the relevant parts.
 
-        - html_content: The parsed HTML from the Markdown content
-        - context: Any "includes" and custom "context" specified in frontmatter
+        - context: The parsed HTML from the Markdown content, as
+          "html_content", plus any "includes" and custom "context"
+          specified in frontmatter
         - template_filepath: An absolute filepath inferred from the frontmatter
-        """
 
-        # Parse frontmatter, and add it to context
-        markdown_template = loader.get_template(filepath)
+        Parsed files are cached until their modification time changes,
+        unless they contain template syntax.
+        """
 
-        if markdown_template.backend.name == "django":
-            file_contents = markdown_template.template.render(Context())
-        else:
-            file_contents = markdown_template.template.render()
-        markdown = frontmatter.loads(file_contents)
+        # Parse frontmatter and content
+        metadata, html_content = _parse_markdown_page(
+            filepath, self.parse_markdown
+        )
 
         # Set the template path
-        wrapper_template = markdown.metadata.get("wrapper_template")
-        context = markdown.metadata.get("context", {})
+        wrapper_template = metadata.get("wrapper_template")
 
         if not wrapper_template:
             # If no wrapper template specified,
@@ -164,22 +594,23 @@ class TemplateFinder(TemplateView):
 
         template_filepath = _relative_template_path(wrapper_template, filepath)
 
-        # Parse core HTML content
-        context["html_content"] = self.parse_markdown(markdown.content)
+        # Copy the context, so the cached metadata is left untouched
+        context = dict(metadata.get("context", {}))
+        context["html_content"] = html_content
 
         # Add any Markdown includes
-        for key, path in markdown.metadata.get(
-            "markdown_includes", {}
-        ).items():
-            include_path = _relative_template_path(path, filepath)
-            include_template = loader.get_template(include_path)
-            if include_template.backend.name == "django":
-                include_content = include_template.template.render(Context())
-            else:
-                include_content = include_template.template.render()
-            context[key] = self.parse_markdown(include_content)
+        includes = metadata.get("markdown_includes", {})
+        include_paths = [
+            _relative_template_path(path, filepath)
+            for path in includes.values()
+        ]
+
+        include_htmls = _parse_markdown_includes(
+            include_paths, self.parse_markdown
+        )
+        context.update(zip(includes.keys(), include_htmls))
 
-        return {"context": context, "template": template_filepath}
+        return MarkdownResult(context, template_filepath)
 
     def render_to_response(self, context, **response_kwargs):
         """
@@ -191,6 +622,10 @@ class TemplateFinder(TemplateView):
         # Response defaults
         response_kwargs.setdefault("content_type", self.content_type)
 
+        # Pick up new templates straight away while developing
+        if settings.DEBUG:
+            _clear_template_caches()
+
         # Find .html or .md template files
         path = self.request.path.lstrip("/")
         matching_template = _get_template(path)
@@ -204,8 +639,31 @@ class TemplateFinder(TemplateView):
             else:
                 raise Http404("Can't find template for " + self.request.path)
 
+        matching_template, is_markdown = matching_template
+
+        # Serve HTML files without template syntax straight from disk
+        if not is_markdown and getattr(
+            settings, "TEMPLATE_FINDER_STATIC_FASTPATH", False
+        ):
+            static_filepath = _static_template_filepath(matching_template)
+
+            if static_filepath:
+                response = FileResponse(
+                    open(static_filepath, "rb"), **response_kwargs
+                )
+
+                # Match the charset a rendered template would be sent with.
+                # This is set afterwards, as FileResponse may replace
+                # a "text/html" type with a guess that has no charset.
+                response["Content-Type"] = (
+                    response_kwargs["content_type"]
+                    or f"text/html; charset={settings.DEFAULT_CHARSET}"
+                )
+
+                return response
+
         # If we found a Markdown file, parse it to find its wrapper template
-        if matching_template.endswith(".md"):
+        if is_markdown:
             markdown_data = self._parse_markdown_file(matching_template)
 
             if not markdown_data:
@@ -213,8 +671,8 @@ class TemplateFinder(TemplateView):
                     self.request.path + " not correctly configurated."
                 )
 
-            matching_template = markdown_data["template"]
-            context.update(markdown_data["context"])
+            matching_template = markdown_data.template_filepath
+            context.update(markdown_data.context)
 
         # Send the response
         return self.response_class(
@@ -222,5 +680,5 @@ class TemplateFinder(TemplateView):
             template=matching_template,
             context=context,
             using=self.template_engine,
-            **response_kwargs
+            **response_kwargs,
         )
@@ -5,7 +5,7 @@ from setuptools import setup, find_packages
 
 setup(
     name="canonicalwebteam.django_views",
-    version="1.4.0",
+    version="2.0.0",
     author="Canonical webteam",
     author_email="webteam@canonical.com",
     url="https://github.com/canonicalwebteam/django_views",
@@ -13,7 +13,8 @@ setup(
     description="Shared Django views for use in Webteam apps",
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
-    install_requires=["mistune", "python-frontmatter", "django"],
+    python_requires=">=3.6",
+    install_requires=["cmarkgfm", "python-frontmatter", "django"],
     tests_require=["Django"],
     test_suite="tests",
 )
@@ -1,11 +1,14 @@
 # Core
 import os
 import unittest
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 # Packages
 import django
 from django.conf import settings
-from django.test import Client
+from django.test import Client, RequestFactory, override_settings
 
 
 this_dir = os.path.dirname(os.path.realpath(__file__))
@@ -22,6 +25,18 @@ settings.configure(
 )
 django.setup()
 
+# Local
+from canonicalwebteam.django_views import (  # noqa: E402
+    TemplateFinder,
+    _INCLUDE_CACHE,
+    _case_insensitive_resolve,
+    _clear_template_caches,
+    _parse_markdown_cached,
+    _template_dirs,
+    _template_trie,
+    _warm_markdown_cache,
+)
+
 
 class TestTemplateFinder(unittest.TestCase):
     django_client = Client()
@@ -53,6 +68,20 @@ class TestTemplateFinder(unittest.TestCase):
             response = self.django_client.get(url)
             self.assertEqual(response.status_code, 404)
 
+    def test_404_skips_markdown_parsing(self):
+        """
+        When no template matches a URL, return a 404
+        before doing any Markdown parsing
+        """
+
+        with mock.patch.object(
+            TemplateFinder, "_parse_markdown_file"
+        ) as parse_markdown_file:
+            response = self.django_client.get("/missing-file")
+
+        self.assertEqual(response.status_code, 404)
+        parse_markdown_file.assert_not_called()
+
     def test_direct_files(self):
         """
         When given a URL to an html file (without the HTML extension),
@@ -95,6 +124,7 @@ class TestTemplateFinder(unittest.TestCase):
         response_three = self.django_client.get("/a-directory/anoTHer-File")
         response_four = self.django_client.get("/a-DIRectoRY/ANOther-FILE")
         response_five = self.django_client.get("/a-directory/mixed-case")
+        response_six = self.django_client.get("/A-dIreCtory/")
 
         self.assertEqual(response_one.status_code, 302)
         self.assertEqual(response_one.get("location"), "/a-directory")
@@ -112,6 +142,76 @@ class TestTemplateFinder(unittest.TestCase):
         self.assertEqual(
             response_five.get("location"), "/a-directory/mIXed-CAse"
         )
+        self.assertEqual(response_six.status_code, 302)
+        self.assertEqual(response_six.get("location"), "/a-directory/")
+
+    def test_static_fastpath(self):
+        """
+        With TEMPLATE_FINDER_STATIC_FASTPATH, HTML files without
+        template syntax are served straight from disk, and other HTML
+        files are still rendered as templates
+        """
+
+        with override_settings(TEMPLATE_FINDER_STATIC_FASTPATH=True):
+            response_one = self.django_client.get("/a-file")
+            response_two = self.django_client.get("/_includes/md-include")
+
+        templated_response = self.django_client.get("/a-file")
+
+        self.assertEqual(response_one.status_code, 200)
+        self.assertTrue(response_one.streaming)
+        self.assertEqual(
+            response_one["Content-Type"], templated_response["Content-Type"]
+        )
+        self.assertEqual(response_one.getvalue(), b"top level file\n")
+        response_one.close()
+
+        self.assertEqual(response_two.status_code, 200)
+        self.assertFalse(response_two.streaming)
+        self.assertTrue(
+            b"<h1>A Markdown template: </h1>" in response_two.content
+        )
+
+    def test_static_fastpath_content_type(self):
+        """
+        Check the static fast path keeps a content type passed
+        to render_to_response
+        """
+
+        view = TemplateFinder()
+        view.setup(RequestFactory().get("/a-file"))
+
+        with override_settings(TEMPLATE_FINDER_STATIC_FASTPATH=True):
+            response = view.render_to_response(
+                {}, content_type="text/plain; charset=utf-8"
+            )
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+        response.close()
+
+    def test_template_trie_symlinks(self):
+        """
+        Check the case-insensitive lookup trie follows every symlink to
+        a directory, including several links to the same directory and
+        links back to a parent directory
+        """
+
+        with tempfile.TemporaryDirectory() as template_dir:
+            shared_dir = os.path.join(template_dir, "shared")
+            os.mkdir(shared_dir)
+            open(os.path.join(shared_dir, "page.html"), "w").close()
+            os.symlink("shared", os.path.join(template_dir, "a"))
+            os.symlink("shared", os.path.join(template_dir, "b"))
+            os.symlink("..", os.path.join(shared_dir, "loop"))
+
+            trie = _template_trie(template_dir)
+
+        for path in ["A", "b", "Shared", "shared/LOOP/b"]:
+            directories = _case_insensitive_resolve(path, trie)
+
+            self.assertEqual(len(directories), 1)
+            self.assertTrue("page.html" in directories[0][1])
 
     # Markdown functionality tests
     # ===
@@ -165,6 +265,23 @@ class TestTemplateFinder(unittest.TestCase):
             b'<a href="https://example.com">a link</a>' in response_two.content
         )
 
+    def test_markdown_multiple_includes(self):
+        """
+        Check several `markdown_includes` are all parsed and passed
+        through to the `markdown_wrapper` template, including when
+        none of them are cached yet
+        """
+
+        _INCLUDE_CACHE.clear()
+
+        response = self.django_client.get("/md-templates/multiple-includes")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            b'<a href="https://example.com">a link</a>' in response.content
+        )
+        self.assertTrue(b"A <em>footer</em>" in response.content)
+
     def test_markdown_context(self):
         """
         Check `context` frontmatter can successfully be passed through to the
@@ -174,6 +291,250 @@ class TestTemplateFinder(unittest.TestCase):
         response = self.django_client.get("/md-templates")
         self.assertTrue(b"The index page" in response.content)
 
+    def test_markdown_table_in_list(self):
+        """
+        Check tables nested inside list items are parsed
+        """
+
+        response = self.django_client.get("/md-templates/table-in-list")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"<li>" in response.content)
+        self.assertTrue(b"<td>Cell</td>" in response.content)
+
+    def test_markdown_raw_html(self):
+        """
+        Check raw HTML, including tags GitHub would filter out,
+        passes through Markdown parsing unchanged
+        """
+
+        response = self.django_client.get("/md-templates/raw-html")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            b'<iframe src="https://www.youtube.com/embed/x"></iframe>'
+            in response.content
+        )
+        self.assertTrue(
+            b"<script>var embedded = true;</script>" in response.content
+        )
+        self.assertTrue(
+            b'<pre><code class="language-python">' in response.content
+        )
+
+    def test_markdown_template_tags(self):
+        """
+        Check Markdown files containing template syntax are still
+        rendered through the template engine before being parsed
+        """
+
+        response = self.django_client.get("/md-templates/template-tags")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"A file using TEMPLATE TAGS" in response.content)
+        self.assertFalse(b"A hidden comment" in response.content)
+
+    def test_markdown_concurrent_requests(self):
+        """
+        Check Markdown pages render correctly when requested
+        from several threads at once
+        """
+
+        def get(url):
+            return Client().get(url).content
+
+        urls = ["/md-templates", "/md-templates/a-file"] * 20
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            contents = list(executor.map(get, urls))
+
+        link = b'<a href="https://example.com">a link</a>'
+
+        for url, content in zip(urls, contents):
+            self.assertTrue(link in content)
+
+            if url == "/md-templates":
+                self.assertTrue(b"<strong>index</strong> file" in content)
+            else:
+                self.assertTrue(b"a <em>md</em> file" in content)
+
+    def test_markdown_custom_parser(self):
+        """
+        Check a subclass overriding `parse_markdown` has its parser
+        used for both the content and the includes
+        """
+
+        class CustomTemplateFinder(TemplateFinder):
+            parse_markdown = staticmethod(lambda markdown: "custom HTML")
+
+        markdown_data = CustomTemplateFinder()._parse_markdown_file(
+            "md-templates/a-file.md"
+        )
+
+        self.assertEqual(markdown_data.context["html_content"], "custom HTML")
+        self.assertEqual(markdown_data.context["nav"], "custom HTML")
+
+        # The default parser's results are unaffected
+        response = self.django_client.get("/md-templates/a-file")
+        self.assertTrue(b"a <em>md</em> file" in response.content)
+
+    def test_markdown_dynamic_template_tags(self):
+        """
+        Check Markdown files with template syntax are rendered
+        for every request, rather than served from the cache
+        """
+
+        response_one = self.django_client.get("/md-templates/dynamic")
+        response_two = self.django_client.get("/md-templates/dynamic")
+
+        self.assertEqual(response_one.status_code, 200)
+        self.assertTrue(b"Rendered at " in response_one.content)
+        self.assertNotEqual(response_one.content, response_two.content)
+
+    def test_markdown_cache(self):
+        """
+        Check parsed Markdown files are reused between requests
+        """
+
+        self.django_client.get("/md-templates")
+        hits_before = _parse_markdown_cached.cache_info().hits
+        response = self.django_client.get("/md-templates")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"<strong>index</strong> file" in response.content)
+        self.assertTrue(_parse_markdown_cached.cache_info().hits > hits_before)
+
+    def test_markdown_cache_modified(self):
+        """
+        Check Markdown pages and includes are parsed afresh
+        once they're modified, without DEBUG
+        """
+
+        temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_dir.cleanup)
+        template_dir = temporary_dir.name
+
+        def write_template(filename, contents):
+            filepath = os.path.join(template_dir, filename)
+
+            with open(filepath, "w") as template_file:
+                template_file.write(contents)
+
+            # Make sure the modification time changes,
+            # however coarse the filesystem's timestamps are
+            mtime = os.stat(filepath).st_mtime_ns + 1_000_000_000
+            os.utime(filepath, ns=(mtime, mtime))
+
+        def write_markdown(version):
+            write_template(
+                "page.md",
+                "---\n"
+                "wrapper_template: wrapper.html\n"
+                "markdown_includes:\n"
+                "  footer: footer.md\n"
+                "---\n\n"
+                f"Page *{version}*\n",
+            )
+            write_template("footer.md", f"Footer *{version}*\n")
+
+        write_template(
+            "wrapper.html",
+            "<main>{{ html_content | safe }}</main>"
+            "<footer>{{ footer | safe }}</footer>",
+        )
+        write_markdown("one")
+
+        templates = [
+            {
+                "BACKEND": "django.template.backends.django.DjangoTemplates",
+                "DIRS": [template_dir],
+            }
+        ]
+
+        def reset_caches():
+            _template_dirs.cache_clear()
+            _clear_template_caches()
+
+        self.addCleanup(reset_caches)
+
+        with override_settings(DEBUG=False, TEMPLATES=templates):
+            reset_caches()
+            response_one = self.django_client.get("/page")
+            write_markdown("two")
+            response_two = self.django_client.get("/page")
+
+        self.assertTrue(b"Page <em>one</em>" in response_one.content)
+        self.assertTrue(b"Footer <em>one</em>" in response_one.content)
+        self.assertTrue(b"Page <em>two</em>" in response_two.content)
+        self.assertTrue(b"Footer <em>two</em>" in response_two.content)
+
+    def test_markdown_cache_debug(self):
+        """
+        Check Markdown is parsed afresh for every request in DEBUG,
+        so changes to templates it uses are picked up
+        """
+
+        with override_settings(DEBUG=True):
+            self.django_client.get("/md-templates")
+            response = self.django_client.get("/md-templates")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(_parse_markdown_cached.cache_info().hits, 0)
+
+    def test_markdown_cache_warming(self):
+        """
+        Check warming the cache parses Markdown files
+        before they're requested
+        """
+
+        _parse_markdown_cached.cache_clear()
+        _warm_markdown_cache(TemplateFinder)
+
+        misses_before = _parse_markdown_cached.cache_info().misses
+        response = self.django_client.get("/md-templates/a-file")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            _parse_markdown_cached.cache_info().misses, misses_before
+        )
+
+    def test_markdown_cache_warming_pages_only(self):
+        """
+        Check warming the cache skips Markdown files without a
+        `wrapper_template`, and stops once the cache is full
+        """
+
+        _parse_markdown_cached.cache_clear()
+        _warm_markdown_cache(TemplateFinder)
+
+        # Only the Markdown files in md-templates have a wrapper_template,
+        # and those with template syntax aren't cached
+        md_templates_dir = os.path.join(
+            this_dir, "fixtures", "templates", "md-templates"
+        )
+        static_pages = []
+
+        for filename in os.listdir(md_templates_dir):
+            with open(os.path.join(md_templates_dir, filename)) as page:
+                if "{%" not in page.read():
+                    static_pages.append(filename)
+
+        self.assertEqual(
+            _parse_markdown_cached.cache_info().currsize, len(static_pages)
+        )
+
+        _parse_markdown_cached.cache_clear()
+        full_cache_info = _parse_markdown_cached.cache_info()._replace(
+            maxsize=2
+        )
+
+        with mock.patch.object(
+            _parse_markdown_cached, "cache_info", return_value=full_cache_info
+        ):
+            _warm_markdown_cache(TemplateFinder)
+
+        self.assertEqual(_parse_markdown_cached.cache_info().currsize, 2)
+
 
 if __name__ == "__main__":
     unittest.main()